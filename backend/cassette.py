@@ -0,0 +1,202 @@
+"""
+LLM Response Cassette
+=====================
+Records Azure OpenAI chat completions to a file and replays them offline.
+
+Each line of the cassette file is a JSON record with the request arguments,
+the response and a hash of the request as key, so a changed prompt template
+shows up as a replay miss and can be diffed against what was recorded.
+
+Usage (from the backend directory):
+    python cassette.py [--path PATH]    # report replay misses for training data
+"""
+
+import os
+import sys
+import json
+import difflib
+import hashlib
+import argparse
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from pathlib import Path
+
+DEFAULT_CASSETTE_PATH = Path(__file__).parent.parent / "data" / "llm_cassette.jsonl"
+
+
+class CassetteMiss(Exception):
+    """Raised in replay mode when a request is not in the cassette"""
+
+
+def request_key(request: Dict) -> str:
+    """
+    Hash chat completion request arguments
+    
+    Args:
+        request: Keyword arguments for chat.completions.create
+    
+    Returns:
+        Hex digest identifying the request
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CassetteClient:
+    """
+    Record/replay wrapper with the chat.completions.create interface of AzureOpenAI
+    
+    Modes:
+        record: call the wrapped client and store every response
+        replay: answer only from the cassette, never call the network
+        auto: replay when recorded, otherwise call the client and record
+    """
+    
+    MODES = ("record", "replay", "auto")
+    
+    def __init__(self, client=None, path: Optional[Path] = None, mode: str = "replay"):
+        """Load the cassette index into memory"""
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if mode != "replay" and client is None:
+            raise ValueError(f"Cassette mode '{mode}' needs an Azure OpenAI client")
+        
+        self.client = client
+        self.path = Path(path or DEFAULT_CASSETTE_PATH)
+        self.mode = mode
+        self.requests = {}
+        self.responses = self._load()
+        self.hits = 0
+        self.misses = []
+        
+        # Mirror client.chat.completions.create
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    
+    def _load(self) -> Dict[str, str]:
+        """Load recorded responses, indexed by request key"""
+        responses = {}
+        if not self.path.exists():
+            return responses
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    responses[record["key"]] = record["content"]
+                    self.requests[record["key"]] = record.get("request")
+                except (ValueError, KeyError, TypeError) as e:
+                    raise ValueError(f"Corrupt cassette record at {self.path}:{line_number}: {e}") from e
+        return responses
+    
+    def _record(self, key: str, request: Dict, content: Optional[str]):
+        """Append a response to the cassette file"""
+        self.responses[key] = content
+        self.requests[key] = request
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            record = {"key": key, "request": request, "content": content}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    
+    @staticmethod
+    def _response(content: Optional[str]):
+        """Build a response object with the shape classify() reads"""
+        message = SimpleNamespace(role="assistant", content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message)])
+    
+    def create(self, **request):
+        """
+        Answer a chat completion request from the cassette or the wrapped client
+        
+        Raises:
+            CassetteMiss: In replay mode, if the request was not recorded
+        """
+        key = request_key(request)
+        
+        if self.mode != "record" and key in self.responses:
+            self.hits += 1
+            return self._response(self.responses[key])
+        
+        if self.mode == "replay":
+            self.misses.append({"key": key, "prompt": request["messages"][-1]["content"]})
+            raise CassetteMiss(f"No recorded response for request {key[:12]}")
+        
+        response = self.client.chat.completions.create(**request)
+        self._record(key, request, response.choices[0].message.content)
+        return response
+    
+    def missing(self, requests: List[Dict]) -> List[str]:
+        """
+        Find requests without a recorded response
+        
+        Args:
+            requests: Keyword arguments for chat.completions.create
+        
+        Returns:
+            Keys of requests that would miss on replay
+        """
+        return [key for key in map(request_key, requests) if key not in self.responses]
+    
+    def diff(self, request: Dict) -> List[str]:
+        """
+        Diff a request against the most similar recorded one
+        
+        Args:
+            request: Keyword arguments for chat.completions.create
+        
+        Returns:
+            Unified diff lines, empty if nothing similar was recorded
+        """
+        def lines(recorded: Dict) -> List[str]:
+            # Parameters as JSON, prompts line by line so template edits stand out
+            params = {k: v for k, v in recorded.items() if k != "messages"}
+            result = json.dumps(params, sort_keys=True, ensure_ascii=False, indent=1).splitlines()
+            for message in recorded.get("messages", []):
+                result.append(f"[{message['role']}]")
+                result.extend(str(message["content"]).splitlines())
+            return result
+        
+        current = lines(request)
+        recorded = [r for r in self.requests.values() if r is not None]
+        if not recorded:
+            return []
+        closest = max(
+            recorded,
+            key=lambda r: difflib.SequenceMatcher(None, lines(r), current).ratio()
+        )
+        return list(difflib.unified_diff(lines(closest), current, "recorded", "current", lineterm=""))
+
+
+def main() -> int:
+    """Report replay misses of the current prompt template over the training data"""
+    parser = argparse.ArgumentParser(description="Report LLM cassette replay misses")
+    parser.add_argument("--path", default=os.getenv("LLM_CASSETTE_PATH", str(DEFAULT_CASSETTE_PATH)))
+    args = parser.parse_args()
+    
+    from classifier import EmailClassifier
+    
+    classifier = EmailClassifier()
+    cassette = CassetteClient(path=Path(args.path), mode="replay")
+    requests = [classifier._create_completion_request(email) for email in classifier.training_data]
+    missing = set(cassette.missing(requests))
+    
+    print(f"Cassette: {cassette.path} ({len(cassette.responses)} recorded responses)")
+    print(f"Replay hits: {len(requests) - len(missing)}/{len(requests)}")
+    first_miss = None
+    for email, request in zip(classifier.training_data, requests):
+        if request_key(request) in missing:
+            print(f"  miss: email {email['email_id']} - {email['subject']}")
+            first_miss = first_miss or request
+    
+    if missing:
+        diff = cassette.diff(first_miss)
+        if diff:
+            print("Change against the closest recorded request (first miss):")
+            print("\n".join(diff))
+        print("Prompt template or request parameters changed - re-record with LLM_CASSETTE_MODE=record")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,18 +7,72 @@ Uses Azure OpenAI for email classification with few-shot learning.
 import os
 import json
 import logging
-from typing import Dict, List
+import random
+import threading
+import time
+from typing import Dict, List, Optional
 from pathlib import Path
-from openai import AzureOpenAI
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
-import numpy as np
 from dotenv import load_dotenv
+from cassette import CassetteMiss
+
+# openai, sklearn and scipy are imported lazily on the paths that use them,
+# so importing this module stays cheap for cold starts
 
 # Load environment variables
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Corrections are stacked into the kNN matrix in chunks, not one by one
+KNN_CHUNK_SIZE = 256
+
+
+def _classification_metrics(true_labels: List[str], predicted_labels: List[str]) -> Dict:
+    """
+    Compute accuracy and support-weighted precision, recall and F1
+    
+    Matches sklearn's average='weighted' with zero_division=0.
+    
+    Args:
+        true_labels: Expected labels
+        predicted_labels: Predicted labels
+        
+    Returns:
+        Dictionary with accuracy, f1_score, precision and recall
+    """
+    total = len(true_labels)
+    labels = set(true_labels) | set(predicted_labels)
+    true_positives = {label: 0 for label in labels}
+    true_counts = {label: 0 for label in labels}
+    predicted_counts = {label: 0 for label in labels}
+    
+    for true_label, predicted_label in zip(true_labels, predicted_labels):
+        true_counts[true_label] += 1
+        predicted_counts[predicted_label] += 1
+        if true_label == predicted_label:
+            true_positives[true_label] += 1
+    
+    precision = recall = f1 = 0.0
+    for label in labels:
+        tp = true_positives[label]
+        label_precision = tp / predicted_counts[label] if predicted_counts[label] else 0.0
+        label_recall = tp / true_counts[label] if true_counts[label] else 0.0
+        denominator = label_precision + label_recall
+        label_f1 = 2 * label_precision * label_recall / denominator if denominator else 0.0
+        
+        weight = true_counts[label] / total if total else 0.0
+        precision += weight * label_precision
+        recall += weight * label_recall
+        f1 += weight * label_f1
+    
+    return {
+        "accuracy": sum(true_positives.values()) / total if total else 0.0,
+        "f1_score": f1,
+        "precision": precision,
+        "recall": recall
+    }
+
+
 class EmailClassifier:
     """
     Email classifier using Azure OpenAI with few-shot learning
@@ -34,13 +88,61 @@ class EmailClassifier:
         # Departments
         self.departments = ["IT", "Księgowość", "Obsługa Klienta", "Sprzedaż"]
         
+        # Short ASCII codes the model answers with in structured decoding
+        self.department_codes = {
+            "IT": "IT",
+            "Księgowość": "KSG",
+            "Obsługa Klienta": "OBS",
+            "Sprzedaż": "SPR"
+        }
+        self.code_departments = {code: dept for dept, code in self.department_codes.items()}
+        
+        # "structured" constrains the output to a department code with a JSON schema,
+        # "text" parses a free-text department name
+        self.label_decoding = os.getenv("LABEL_DECODING", "structured")
+        if self.label_decoding not in ("structured", "text"):
+            raise ValueError(
+                f"Unknown LABEL_DECODING: {self.label_decoding} (expected 'structured' or 'text')"
+            )
+        
         # Load training examples
         self.training_data = self._load_training_data()
         
+        # Human corrections recorded through feedback, one JSON line per correction
+        self.feedback_path = Path(os.getenv(
+            "FEEDBACK_DATA_PATH",
+            Path(__file__).parent.parent / "data" / "feedback_emails.jsonl"
+        ))
+        self._feedback_index = {}
+        self._feedback_records = 0
+        self.feedback_data = self._load_feedback_data()
+        
+        # Local model: answers without the LLM only when confident enough.
+        # The SGD model is only trusted once enough corrections have been
+        # recorded, the seed data alone is too small to skip the LLM
+        self.local_knn_threshold = float(os.getenv("LOCAL_KNN_THRESHOLD", "0.9"))
+        self.local_model_threshold = float(os.getenv("LOCAL_MODEL_THRESHOLD", "0.9"))
+        self.local_model_min_feedback = int(os.getenv("LOCAL_MODEL_MIN_FEEDBACK", "50"))
+        
+        # Continues from the persisted feedback, so it does not repeat after a restart
+        self.model_version = max(
+            [e.get("model_version", 0) for e in self.feedback_data] + [self._feedback_records]
+        )
+        self._vectorizer = None
+        self._local_model = None
+        self._knn_vectors = None
+        self._knn_pending = []
+        self._knn_labels = []
+        
+        # Warm-up runs in a worker thread while requests may already arrive
+        self._lock = threading.RLock()
+        
         # Initialize client if credentials are available
         self.client = None
         if self.azure_endpoint and self.api_key:
             try:
+                from openai import AzureOpenAI
+                
                 self.client = AzureOpenAI(
                     azure_endpoint=self.azure_endpoint,
                     api_key=self.api_key,
@@ -49,6 +151,20 @@ class EmailClassifier:
                 logger.info("Azure OpenAI client initialized successfully")
             except Exception as e:
                 logger.warning(f"Failed to initialize Azure OpenAI client: {e}")
+        
+        # Record/replay LLM responses: off, record, replay or auto.
+        # Setup errors are raised, a replay-only run must never fall
+        # through to live network calls
+        self.cassette_mode = os.getenv("LLM_CASSETTE_MODE", "off")
+        if self.cassette_mode != "off":
+            from cassette import CassetteClient, DEFAULT_CASSETTE_PATH
+            
+            self.client = CassetteClient(
+                client=self.client,
+                path=Path(os.getenv("LLM_CASSETTE_PATH", DEFAULT_CASSETTE_PATH)),
+                mode=self.cassette_mode
+            )
+            logger.info(f"LLM cassette enabled in {self.cassette_mode} mode")
     
     def _load_training_data(self) -> List[Dict]:
         """Load training data from JSON file"""
@@ -60,6 +176,238 @@ class EmailClassifier:
             logger.error(f"Error loading training data: {e}")
             return []
     
+    def _load_feedback_data(self) -> List[Dict]:
+        """
+        Load recorded human corrections from the JSONL feedback store
+        
+        A later record for the same classification replaces the earlier one.
+        Errors are raised rather than treated as an empty store, so existing
+        corrections are never overwritten.
+        """
+        feedback_data = []
+        if not self.feedback_path.exists():
+            return feedback_data
+        with open(self.feedback_path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    example = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(
+                        f"Corrupt feedback record at {self.feedback_path}:{line_number}: {e}"
+                    ) from e
+                if not isinstance(example, dict) or "label" not in example:
+                    raise ValueError(
+                        f"Corrupt feedback record at {self.feedback_path}:{line_number}: no label"
+                    )
+                
+                self._feedback_records += 1
+                classification_id = example.get("classification_id")
+                if classification_id is not None and classification_id in self._feedback_index:
+                    feedback_data[self._feedback_index[classification_id]] = example
+                    continue
+                if classification_id is not None:
+                    self._feedback_index[classification_id] = len(feedback_data)
+                feedback_data.append(example)
+        return feedback_data
+    
+    def _append_feedback(self, example: Dict):
+        """Append one correction to the feedback store"""
+        self.feedback_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.feedback_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(example, ensure_ascii=False) + "\n")
+        self._feedback_records += 1
+    
+    @staticmethod
+    def _email_text(email: Dict) -> str:
+        """Text used by the local model"""
+        return f"{email['subject']} {email['body']}"
+    
+    def _ensure_local_model(self):
+        """
+        Build the local model on first use
+        
+        A hashing vectorizer needs no fitted vocabulary, so new examples
+        can be learned with partial_fit without retraining from scratch.
+        """
+        with self._lock:
+            if self._local_model is not None:
+                return
+            
+            from sklearn.feature_extraction.text import HashingVectorizer
+            from sklearn.linear_model import SGDClassifier
+            
+            vectorizer = HashingVectorizer(
+                n_features=2 ** 18,
+                alternate_sign=False,
+                ngram_range=(1, 2)
+            )
+            local_model = SGDClassifier(loss="log_loss", alpha=1e-4, random_state=42)
+            
+            labelled = self.training_data + self.feedback_data
+            if labelled:
+                X = vectorizer.transform([self._email_text(e) for e in labelled])
+                y = [e["label"] for e in labelled]
+                for _ in range(10):
+                    local_model.partial_fit(X, y, classes=self.departments)
+            
+            # Nearest-neighbour memory of corrected emails
+            knn_vectors = None
+            knn_labels = []
+            if self.feedback_data:
+                knn_vectors = vectorizer.transform(
+                    [self._email_text(e) for e in self.feedback_data]
+                )
+                knn_labels = [e["label"] for e in self.feedback_data]
+            
+            # Publish only fully built state
+            self._vectorizer = vectorizer
+            self._knn_vectors = knn_vectors
+            self._knn_pending = []
+            self._knn_labels = knn_labels
+            self._local_model = local_model
+    
+    def warm_up(self):
+        """Load the local model so the first request does not pay for it"""
+        self._ensure_local_model()
+    
+    def _local_classify(self, email: Dict) -> Optional[Dict]:
+        """
+        Classify with the local model, without calling the LLM
+        
+        Args:
+            email: Email to classify
+            
+        Returns:
+            Classification result, or None if the local model is not confident
+        """
+        self._ensure_local_model()
+        with self._lock:
+            return self._predict_local(email)
+    
+    def _predict_local(self, email: Dict) -> Optional[Dict]:
+        """Run the local model, the caller holds the lock"""
+        x = self._vectorizer.transform([self._email_text(email)])
+        
+        # A near-duplicate of a corrected email takes the corrected label,
+        # the newest correction wins between equally similar ones
+        if self._knn_labels:
+            similarities = self._knn_similarities(x)
+            nearest = len(similarities) - 1 - int(similarities[::-1].argmax())
+            if similarities[nearest] >= self.local_knn_threshold:
+                return {
+                    "label": self._knn_labels[nearest],
+                    "confidence": round(min(float(similarities[nearest]), 0.99), 2),
+                    "method": "local-knn"
+                }
+        
+        if len(self.feedback_data) < self.local_model_min_feedback:
+            return None
+        if not hasattr(self._local_model, "classes_"):
+            return None
+        
+        probabilities = self._local_model.predict_proba(x)[0]
+        best = int(probabilities.argmax())
+        if probabilities[best] >= self.local_model_threshold:
+            return {
+                "label": str(self._local_model.classes_[best]),
+                "confidence": round(min(float(probabilities[best]), 0.99), 2),
+                "method": "local-model"
+            }
+        
+        return None
+    
+    def _knn_similarities(self, x):
+        """Similarity of a vector to every stored correction, in storage order"""
+        import numpy as np
+        from scipy import sparse
+        
+        parts = []
+        if self._knn_vectors is not None:
+            parts.append((self._knn_vectors @ x.T).toarray().ravel())
+        if self._knn_pending:
+            parts.append((sparse.vstack(self._knn_pending, format="csr") @ x.T).toarray().ravel())
+        return np.concatenate(parts)
+    
+    def _add_knn_row(self, x):
+        """Add a correction vector, stacking new rows into the matrix in chunks"""
+        self._knn_pending.append(x)
+        if len(self._knn_pending) < KNN_CHUNK_SIZE:
+            return
+        
+        from scipy import sparse
+        
+        blocks = [self._knn_vectors] if self._knn_vectors is not None else []
+        self._knn_vectors = sparse.vstack(blocks + self._knn_pending, format="csr")
+        self._knn_pending = []
+    
+    def learn(self, email: Dict, label: str, classification_id: Optional[str] = None) -> Dict:
+        """
+        Learn from a human correction without retraining
+        
+        Appends the corrected email to the feedback store, updates the local
+        model with partial_fit, adds it to the nearest-neighbour memory and
+        bumps the model version so results cached under an older version
+        can be invalidated. Correcting the same classification again
+        replaces its earlier correction.
+        
+        Args:
+            email: Email dict with subject, body, and optional sender
+            label: Corrected department label
+            classification_id: Classification being corrected, if known
+            
+        Returns:
+            Update summary with model version and timing
+        """
+        if label not in self.departments:
+            raise ValueError(f"Unknown department: {label}")
+        
+        start = time.perf_counter()
+        
+        self._ensure_local_model()
+        with self._lock:
+            self.model_version += 1
+            
+            existing = self._feedback_index.get(classification_id)
+            
+            if existing is not None:
+                # Re-correction: same email, so only the label changes
+                example = {
+                    **self.feedback_data[existing],
+                    "label": label,
+                    "model_version": self.model_version
+                }
+                self.feedback_data[existing] = example
+                self._knn_labels[existing] = label
+            else:
+                example = {
+                    "email_id": len(self.training_data) + len(self.feedback_data) + 1,
+                    "subject": email["subject"],
+                    "body": email["body"],
+                    "sender": email.get("sender"),
+                    "label": label,
+                    "classification_id": classification_id,
+                    "model_version": self.model_version
+                }
+                if classification_id is not None:
+                    self._feedback_index[classification_id] = len(self.feedback_data)
+                self.feedback_data.append(example)
+            self._append_feedback(example)
+            
+            x = self._vectorizer.transform([self._email_text(example)])
+            self._local_model.partial_fit(x, [label], classes=self.departments)
+            
+            if existing is None:
+                self._add_knn_row(x)
+                self._knn_labels.append(label)
+            
+            return {
+                "model_version": self.model_version,
+                "feedback_count": len(self.feedback_data),
+                "update_ms": round((time.perf_counter() - start) * 1000, 2)
+            }
+    
     def _create_few_shot_prompt(self, email: Dict) -> str:
         """
         Create few-shot learning prompt with examples
@@ -100,10 +448,96 @@ Przykłady sklasyfikowanych e-maili:
         prompt += f"\n\nE-mail do klasyfikacji:\n"
         prompt += f"Temat: {email['subject']}\n"
         prompt += f"Treść: {email['body']}\n"
-        prompt += f"\nOdpowiedz TYLKO nazwą działu (IT, Księgowość, Obsługa Klienta, lub Sprzedaż)."
+        if self.label_decoding == "structured":
+            codes = ", ".join(f"{code} = {dept}" for dept, code in self.department_codes.items())
+            prompt += f"\nOdpowiedz TYLKO kodem działu ({codes})."
+        else:
+            prompt += f"\nOdpowiedz TYLKO nazwą działu (IT, Księgowość, Obsługa Klienta, lub Sprzedaż)."
         
         return prompt
     
+    def _create_completion_request(self, email: Dict) -> Dict:
+        """
+        Create chat completion request arguments for an email
+        
+        Args:
+            email: Email to classify
+            
+        Returns:
+            Keyword arguments for chat.completions.create
+        """
+        prompt = self._create_few_shot_prompt(email)
+        
+        if self.label_decoding == "structured":
+            # The schema only admits department codes, so the output is always valid
+            return {
+                "model": self.deployment_name,
+                "messages": [
+                    {"role": "system", "content": "Jesteś ekspertem od klasyfikacji e-maili. Odpowiadaj tylko kodem działu."},
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": 0.1,
+                "max_tokens": 10,
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "department",
+                        "strict": True,
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "code": {"type": "string", "enum": list(self.code_departments)}
+                            },
+                            "required": ["code"],
+                            "additionalProperties": False
+                        }
+                    }
+                }
+            }
+        
+        return {
+            "model": self.deployment_name,
+            "messages": [
+                {"role": "system", "content": "Jesteś ekspertem od klasyfikacji e-maili. Odpowiadaj tylko nazwą działu."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.1,
+            "max_tokens": 50
+        }
+    
+    def _parse_label(self, content: Optional[str]) -> Optional[str]:
+        """
+        Parse a department label from model output
+        
+        Args:
+            content: Model output
+            
+        Returns:
+            Department label, or None if the output is invalid
+        """
+        if content is None:
+            return None
+        
+        if self.label_decoding == "structured":
+            try:
+                code = json.loads(content).get("code")
+            except (ValueError, AttributeError):
+                return None
+            if not isinstance(code, str):
+                return None
+            return self.code_departments.get(code)
+        
+        predicted_label = content.strip()
+        if predicted_label in self.departments:
+            return predicted_label
+        
+        # Try to match partial response
+        for dept in self.departments:
+            if dept.lower() in predicted_label.lower():
+                return dept
+        
+        return None
+    
     def _fallback_classify(self, email: Dict) -> Dict:
         """
         Fallback rule-based classifier when Azure OpenAI is not available
@@ -149,46 +583,36 @@ Przykłady sklasyfikowanych e-maili:
             "method": "rule-based"
         }
     
-    def classify(self, email: Dict) -> Dict:
+    def classify(self, email: Dict, use_local: bool = True) -> Dict:
         """
         Classify an email to appropriate department
         
         Args:
             email: Email dict with subject, body, and optional sender
+            use_local: Try the local model before Azure OpenAI
             
         Returns:
             Classification result with label and confidence
         """
-        # Try Azure OpenAI first
+        # Try the local model first
+        if use_local:
+            local_result = self._local_classify(email)
+            if local_result:
+                return local_result
+        
+        # Then Azure OpenAI
         if self.client:
             try:
-                prompt = self._create_few_shot_prompt(email)
-                
-                response = self.client.chat.completions.create(
-                    model=self.deployment_name,
-                    messages=[
-                        {"role": "system", "content": "Jesteś ekspertem od klasyfikacji e-maili. Odpowiadaj tylko nazwą działu."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.1,
-                    max_tokens=50
-                )
+                request = self._create_completion_request(email)
+                response = self.client.chat.completions.create(**request)
+                predicted_label = self._parse_label(response.choices[0].message.content)
                 
-                predicted_label = response.choices[0].message.content.strip()
-                
-                # Validate prediction
-                if predicted_label not in self.departments:
-                    # Try to match partial response
-                    for dept in self.departments:
-                        if dept.lower() in predicted_label.lower():
-                            predicted_label = dept
-                            break
-                    else:
-                        # Fallback if invalid
-                        return self._fallback_classify(email)
+                if predicted_label is None:
+                    # Fallback if invalid
+                    return self._fallback_classify(email)
                 
                 # Calculate confidence based on response
-                confidence = 0.85 + (np.random.random() * 0.10)  # 0.85-0.95
+                confidence = 0.85 + (random.random() * 0.10)  # 0.85-0.95
                 
                 return {
                     "label": predicted_label,
@@ -196,6 +620,9 @@ Przykłady sklasyfikowanych e-maili:
                     "method": "azure-openai"
                 }
                 
+            except CassetteMiss:
+                # A replay miss must not pass for an LLM result
+                raise
             except Exception as e:
                 logger.error(f"Azure OpenAI classification failed: {e}")
                 return self._fallback_classify(email)
@@ -209,6 +636,9 @@ Przykłady sklasyfikowanych e-maili:
         
         Returns:
             Dictionary with metrics (accuracy, F1, precision, recall)
+            
+        Raises:
+            CassetteMiss: In cassette replay mode, if a request was not recorded
         """
         if not self.training_data:
             return {
@@ -222,23 +652,21 @@ Przykłady sklasyfikowanych e-maili:
         true_labels = []
         predicted_labels = []
         
-        # Classify all training examples
+        # Classify all training examples. The local model learns from this
+        # data, so it is left out to keep the metrics meaningful
         for email in self.training_data:
-            result = self.classify(email)
+            result = self.classify(email, use_local=False)
             predicted_labels.append(result["label"])
             true_labels.append(email["label"])
         
         # Calculate metrics
-        accuracy = accuracy_score(true_labels, predicted_labels)
-        f1 = f1_score(true_labels, predicted_labels, average='weighted')
-        precision = precision_score(true_labels, predicted_labels, average='weighted', zero_division=0)
-        recall = recall_score(true_labels, predicted_labels, average='weighted', zero_division=0)
+        metrics = _classification_metrics(true_labels, predicted_labels)
         
         return {
-            "accuracy": round(accuracy, 3),
-            "f1_score": round(f1, 3),
-            "precision": round(precision, 3),
-            "recall": round(recall, 3),
+            "accuracy": round(metrics["accuracy"], 3),
+            "f1_score": round(metrics["f1_score"], 3),
+            "precision": round(metrics["precision"], 3),
+            "recall": round(metrics["recall"], 3),
             "total_predictions": len(predicted_labels)
         }
     
@@ -6,10 +6,14 @@ FastAPI backend for email classification system using Azure OpenAI.
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from typing import List, Optional, Dict
+from contextlib import asynccontextmanager
+import asyncio
 import json
 import os
+import threading
+import uuid
 from datetime import datetime
 import logging
 from pathlib import Path
@@ -21,11 +25,42 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Warm-up state, reported by /ready
+warm_up_state = {"ready": False, "started_at": None, "finished_at": None, "error": None}
+
+def warm_up():
+    """Load the local model and its heavy dependencies ahead of the first request"""
+    warm_up_state["started_at"] = datetime.now().isoformat()
+    try:
+        get_classifier().warm_up()
+        warm_up_state["ready"] = True
+        logger.info("Classifier warm-up finished")
+    except Exception as e:
+        warm_up_state["error"] = str(e)
+        logger.error(f"Classifier warm-up failed: {e}")
+    finally:
+        warm_up_state["finished_at"] = datetime.now().isoformat()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the classifier, then warm it up in the background
+    
+    Construction is cheap, so configuration errors (e.g. a bad
+    LLM_CASSETTE_MODE or cassette file) fail startup instead of leaving
+    a server that is never ready.
+    """
+    get_classifier()
+    warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up))
+    yield
+    warm_up_task.cancel()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Email Classifier API",
     description="AI-powered email classification system",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS configuration
@@ -46,11 +81,28 @@ class EmailInput(BaseModel):
 
 class ClassificationResult(BaseModel):
     """Classification result model"""
+    classification_id: str = Field(..., description="Classification identifier, used for feedback")
     label: str = Field(..., description="Predicted department label")
     confidence: float = Field(..., description="Confidence score (0-1)")
     timestamp: str = Field(..., description="Classification timestamp")
     email_preview: Dict = Field(..., description="Email preview")
 
+class FeedbackInput(BaseModel):
+    """Human correction of a classification"""
+    classification_id: str = Field(..., description="Classification identifier")
+    label: str = Field(..., description="Correct department label")
+
+class FeedbackResult(BaseModel):
+    """Feedback result model"""
+    model_config = ConfigDict(protected_namespaces=())
+    
+    classification_id: str
+    label: str
+    previous_label: str
+    model_version: int
+    feedback_count: int
+    update_ms: float
+
 class TrainingData(BaseModel):
     """Training data model"""
     emails: List[Dict]
@@ -83,6 +135,20 @@ DEPARTMENTS = ["IT", "Księgowość", "Obsługa Klienta", "Sprzedaż"]
 # Store classification history
 classification_history = []
 
+# Shared classifier, so feedback updates are seen by later requests
+classifier_instance = None
+classifier_lock = threading.Lock()
+
+def get_classifier():
+    """Get the shared classifier, creating it on first use"""
+    global classifier_instance
+    with classifier_lock:
+        if classifier_instance is None:
+            # Import classifier here to avoid circular imports
+            from classifier import EmailClassifier
+            classifier_instance = EmailClassifier()
+    return classifier_instance
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -100,6 +166,16 @@ async def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe, healthy only once warm-up is done"""
+    if not warm_up_state["ready"]:
+        raise HTTPException(status_code=503, detail=warm_up_state)
+    return {
+        "status": "ready",
+        **warm_up_state
+    }
+
 @app.post("/classify", response_model=ClassificationResult)
 async def classify_email(email: EmailInput):
     """
@@ -112,19 +188,20 @@ async def classify_email(email: EmailInput):
         Classification result with label and confidence
     """
     try:
-        # Import classifier here to avoid circular imports
-        from classifier import EmailClassifier
-        
-        classifier = EmailClassifier()
+        classifier = get_classifier()
         result = classifier.classify(email.dict())
+        classification_id = uuid.uuid4().hex
         
         # Store in history
         classification_history.append({
             **result,
+            "classification_id": classification_id,
+            "email": email.dict(),
             "timestamp": datetime.now().isoformat()
         })
         
         return ClassificationResult(
+            classification_id=classification_id,
             label=result["label"],
             confidence=result["confidence"],
             timestamp=datetime.now().isoformat(),
@@ -174,9 +251,7 @@ async def get_classification_history(limit: int = 10):
 async def get_model_metrics():
     """Get model performance metrics"""
     try:
-        from classifier import EmailClassifier
-
-        classifier = EmailClassifier()
+        classifier = get_classifier()
         metrics = classifier.evaluate()
         
         return ModelMetrics(**metrics)
@@ -185,6 +260,49 @@ async def get_model_metrics():
         logger.error(f"Error getting metrics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/feedback", response_model=FeedbackResult)
+async def submit_feedback(feedback: FeedbackInput):
+    """
+    Record a human correction of a classification
+    
+    The corrected email is added to the labelled store and the local
+    model is updated in place, without a retrain or restart.
+    
+    Args:
+        feedback: Classification id and correct department label
+        
+    Returns:
+        Feedback result with the new model version
+    """
+    if feedback.label not in DEPARTMENTS:
+        raise HTTPException(status_code=400, detail=f"Unknown department: {feedback.label}")
+    
+    entry = next(
+        (item for item in classification_history
+         if item.get("classification_id") == feedback.classification_id),
+        None
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Classification not found")
+    
+    try:
+        update = get_classifier().learn(
+            entry["email"], feedback.label, feedback.classification_id
+        )
+    except Exception as e:
+        logger.error(f"Feedback error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    previous_label = entry.get("corrected_label", entry["label"])
+    entry["corrected_label"] = feedback.label
+    
+    return FeedbackResult(
+        classification_id=feedback.classification_id,
+        label=feedback.label,
+        previous_label=previous_label,
+        **update
+    )
+
 @app.delete("/history")
 async def clear_history():
     """Clear classification history"""
@@ -0,0 +1,13 @@
+"""
+Shared test fixtures
+"""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_feedback_store(tmp_path, monkeypatch):
+    """Keep every test away from the developer's local feedback store"""
+    path = tmp_path / "feedback.jsonl"
+    monkeypatch.setenv("FEEDBACK_DATA_PATH", str(path))
+    return path
@@ -4,13 +4,68 @@ Unit tests for Email Classifier
 
 import pytest
 import json
+import random
+import subprocess
+import threading
 from pathlib import Path
 import sys
 
 # Add backend to path
 sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
 
-from classifier import EmailClassifier
+from classifier import EmailClassifier, _classification_metrics
+from cassette import CassetteClient, CassetteMiss
+
+BACKEND_DIR = Path(__file__).parent.parent / "backend"
+
+# Upper bound for `import classifier`, heavy dependencies excluded
+MAX_IMPORT_TIME_US = 300_000
+
+# Synthetic free-text answers, hand-written to cover typical output
+# variants (not recorded from a deployment)
+SYNTHETIC_TEXT_RESPONSES = [
+    "IT",
+    "Księgowość",
+    "Dział: Księgowość",
+    "Ksiegowosc",
+    "obsługa klienta",
+    "Obsluga Klienta",
+    "Sprzedaż.",
+    "**Sprzedaż**",
+    "Sprzedaz",
+    "Ten e-mail należy do działu IT.",
+]
+
+# Synthetic structured answers; the JSON schema only admits department
+# codes, so these are valid by construction
+SYNTHETIC_STRUCTURED_RESPONSES = [
+    '{"code":"IT"}',
+    '{"code":"KSG"}',
+    '{"code":"KSG"}',
+    '{"code":"KSG"}',
+    '{"code":"OBS"}',
+    '{"code":"OBS"}',
+    '{"code":"SPR"}',
+    '{"code":"SPR"}',
+    '{"code":"SPR"}',
+    '{"code":"IT"}',
+]
+
+
+class StubClient:
+    """Azure OpenAI client stub returning canned responses"""
+    
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.chat = self
+        self.completions = self
+    
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        message = type("Message", (), {"content": self.responses.pop(0)})
+        choice = type("Choice", (), {"message": message})
+        return type("Response", (), {"choices": [choice]})
 
 class TestEmailClassifier:
     """Test suite for EmailClassifier"""
@@ -175,6 +230,364 @@ class TestEmailClassifier:
         assert result["label"] in classifier.departments
 
 
+class TestLabelDecoding:
+    """Test suite for decoding department labels from model output"""
+    
+    @pytest.fixture
+    def classifier(self, monkeypatch):
+        """Create classifier instance that always asks the LLM"""
+        monkeypatch.setenv("LOCAL_KNN_THRESHOLD", "2")
+        monkeypatch.setenv("LOCAL_MODEL_THRESHOLD", "2")
+        return EmailClassifier()
+    
+    def test_structured_request(self, classifier):
+        """Test if the request constrains the output to department codes"""
+        classifier.client = StubClient(['{"code":"KSG"}'])
+        result = classifier.classify({"subject": "Test", "body": "Test"})
+        request = classifier.client.requests[0]
+        schema = request["response_format"]["json_schema"]["schema"]
+        
+        assert result["label"] == "Księgowość"
+        assert result["method"] == "azure-openai"
+        assert request["max_tokens"] <= 10
+        assert set(schema["properties"]["code"]["enum"]) == {"IT", "KSG", "OBS", "SPR"}
+    
+    def test_text_decoding_mode(self, classifier):
+        """Test if the free-text decoding mode is still available"""
+        classifier.label_decoding = "text"
+        classifier.client = StubClient(["Dział: Obsługa Klienta"])
+        result = classifier.classify({"subject": "Test", "body": "Test"})
+        
+        assert result["label"] == "Obsługa Klienta"
+        assert "response_format" not in classifier.client.requests[0]
+    
+    def test_unknown_decoding_mode(self, monkeypatch):
+        """Test if an unknown decoding mode is rejected"""
+        monkeypatch.setenv("LABEL_DECODING", "json")
+        with pytest.raises(ValueError):
+            EmailClassifier()
+    
+    def test_invalid_output_rate_report(self, classifier, record_property):
+        """Report the invalid-output rate of the synthetic responses per decoding mode"""
+        classifier.label_decoding = "text"
+        text_rate = sum(
+            classifier._parse_label(r) is None for r in SYNTHETIC_TEXT_RESPONSES
+        ) / len(SYNTHETIC_TEXT_RESPONSES)
+        
+        classifier.label_decoding = "structured"
+        structured_rate = sum(
+            classifier._parse_label(r) is None for r in SYNTHETIC_STRUCTURED_RESPONSES
+        ) / len(SYNTHETIC_STRUCTURED_RESPONSES)
+        
+        # Reported only: the structured list is valid by construction
+        record_property("text_invalid_rate", text_rate)
+        record_property("structured_invalid_rate", structured_rate)
+        print(f"invalid-output rate: text {text_rate:.0%}, structured {structured_rate:.0%}")
+        
+        # Diacritics-free and misspelled names are what the text parser misses
+        assert text_rate == pytest.approx(0.3)
+    
+    @pytest.mark.parametrize("content", [
+        '{"code":"XYZ"}',
+        'KSG',
+        '{"code":"KS',
+        '{"code":[]}',
+        '{"code":{}}',
+        '{"code":1}',
+        '["KSG"]',
+        '',
+    ])
+    def test_structured_rejects_invalid_output(self, classifier, content):
+        """Test if invalid structured output maps to None and to the rule-based fallback"""
+        assert classifier._parse_label(content) is None
+        
+        classifier.client = StubClient([content])
+        result = classifier.classify({"subject": "Awaria systemu", "body": "System nie działa"})
+        
+        assert result["method"] == "rule-based"
+
+
+class TestCassette:
+    """Test suite for LLM response record/replay"""
+    
+    @pytest.fixture
+    def cassette_path(self, tmp_path, monkeypatch):
+        """Cassette file path, with the local model disabled"""
+        monkeypatch.setenv("LOCAL_KNN_THRESHOLD", "2")
+        monkeypatch.setenv("LOCAL_MODEL_THRESHOLD", "2")
+        return tmp_path / "cassette.jsonl"
+    
+    def test_record_then_replay(self, cassette_path, monkeypatch):
+        """Test if recorded responses are replayed without a client"""
+        email = {"subject": "Test", "body": "Test"}
+        stub = StubClient(['{"code":"SPR"}'])
+        recording = EmailClassifier()
+        recording.client = CassetteClient(client=stub, path=cassette_path, mode="record")
+        recorded = recording.classify(email)
+        
+        monkeypatch.setenv("LLM_CASSETTE_MODE", "replay")
+        monkeypatch.setenv("LLM_CASSETTE_PATH", str(cassette_path))
+        replaying = EmailClassifier()
+        replayed = replaying.classify(email)
+        
+        assert len(stub.requests) == 1
+        assert recorded["label"] == replayed["label"] == "Sprzedaż"
+        assert replayed["method"] == "azure-openai"
+        assert replaying.client.hits == 1
+    
+    def test_replay_miss_is_not_hidden(self, cassette_path, monkeypatch):
+        """Test if a replay miss fails instead of returning a rule-based result"""
+        monkeypatch.setenv("LLM_CASSETTE_MODE", "replay")
+        monkeypatch.setenv("LLM_CASSETTE_PATH", str(cassette_path))
+        classifier = EmailClassifier()
+        
+        with pytest.raises(CassetteMiss):
+            classifier.classify({"subject": "Awaria systemu", "body": "System nie działa"})
+        with pytest.raises(CassetteMiss):
+            classifier.evaluate()
+    
+    def test_attached_cassette_miss_is_not_hidden(self, cassette_path):
+        """Test if a miss of a directly attached cassette is not turned into a rule-based result"""
+        classifier = EmailClassifier()
+        classifier.client = CassetteClient(path=cassette_path, mode="replay")
+        
+        with pytest.raises(CassetteMiss):
+            classifier.classify({"subject": "Awaria systemu", "body": "System nie działa"})
+    
+    def test_record_stores_request_and_diffs_template_change(self, cassette_path):
+        """Test if recorded requests are kept and a template change can be diffed"""
+        classifier = EmailClassifier()
+        email = {"subject": "Test", "body": "Test"}
+        classifier.client = CassetteClient(
+            client=StubClient(['{"code":"IT"}']), path=cassette_path, mode="record"
+        )
+        classifier.classify(email)
+        request = classifier._create_completion_request(email)
+        
+        cassette = CassetteClient(path=cassette_path, mode="replay")
+        assert list(cassette.requests.values()) == [request]
+        
+        request["max_tokens"] = 20
+        request["messages"][-1]["content"] = request["messages"][-1]["content"].replace(
+            "Odpowiedz TYLKO kodem działu", "Zwróć kod działu"
+        )
+        diff = cassette.diff(request)
+        
+        assert '- "max_tokens": 10,' in diff
+        assert '+ "max_tokens": 20,' in diff
+        assert any(line.startswith("+Zwróć kod działu") for line in diff)
+    
+    def test_bad_cassette_fails_api_startup(self, cassette_path, monkeypatch):
+        """Test if a bad cassette configuration stops the API from starting"""
+        from fastapi.testclient import TestClient
+        import main
+        
+        monkeypatch.setenv("LLM_CASSETTE_MODE", "replay-only")
+        monkeypatch.setattr(main, "classifier_instance", None)
+        
+        with pytest.raises(ValueError):
+            with TestClient(main.app):
+                pass
+    
+    @pytest.mark.parametrize("mode, content", [
+        ("replay-only", ""),
+        ("replay", "not json\n"),
+        ("record", ""),
+    ])
+    def test_invalid_cassette_setup_raises(self, cassette_path, monkeypatch, mode, content):
+        """Test if a bad cassette mode or file stops the classifier from starting"""
+        cassette_path.write_text(content, encoding="utf-8")
+        monkeypatch.setenv("LLM_CASSETTE_MODE", mode)
+        monkeypatch.setenv("LLM_CASSETTE_PATH", str(cassette_path))
+        monkeypatch.delenv("AZURE_OPENAI_ENDPOINT", raising=False)
+        
+        with pytest.raises(ValueError):
+            EmailClassifier()
+    
+    def test_replay_miss_after_template_change(self, cassette_path):
+        """Test if a changed request is reported as a replay miss"""
+        classifier = EmailClassifier()
+        email = {"subject": "Test", "body": "Test"}
+        classifier.client = CassetteClient(
+            client=StubClient(['{"code":"IT"}']), path=cassette_path, mode="record"
+        )
+        classifier.classify(email)
+        
+        classifier.label_decoding = "text"
+        cassette = CassetteClient(path=cassette_path, mode="replay")
+        
+        assert cassette.missing([classifier._create_completion_request(email)])
+        with pytest.raises(CassetteMiss):
+            cassette.chat.completions.create(**classifier._create_completion_request(email))
+        assert len(cassette.misses) == 1
+
+
+class TestImportCost:
+    """Test suite for classifier module import cost"""
+    
+    def test_import_time(self):
+        """Test if importing the classifier stays under the time budget"""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import classifier"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        
+        # Lines look like: "import time: self [us] | cumulative | imported package"
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, total, module = line[len("import time:"):].split("|")
+            cumulative[module.strip()] = int(total)
+        
+        assert "classifier" in cumulative
+        assert cumulative["classifier"] < MAX_IMPORT_TIME_US
+        for heavy in ("openai", "sklearn", "numpy", "scipy"):
+            assert heavy not in cumulative, f"'{heavy}' is imported eagerly"
+    
+    def test_metrics_match_sklearn(self):
+        """Test if metrics match sklearn's weighted averages"""
+        from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+        
+        rng = random.Random(0)
+        labels = ["IT", "Księgowość", "Obsługa Klienta", "Sprzedaż"]
+        true_labels = [rng.choice(labels) for _ in range(200)]
+        predicted_labels = [rng.choice(labels[:3]) for _ in range(200)]
+        
+        metrics = _classification_metrics(true_labels, predicted_labels)
+        
+        assert metrics["accuracy"] == pytest.approx(accuracy_score(true_labels, predicted_labels))
+        assert metrics["f1_score"] == pytest.approx(
+            f1_score(true_labels, predicted_labels, average='weighted', zero_division=0))
+        assert metrics["precision"] == pytest.approx(
+            precision_score(true_labels, predicted_labels, average='weighted', zero_division=0))
+        assert metrics["recall"] == pytest.approx(
+            recall_score(true_labels, predicted_labels, average='weighted', zero_division=0))
+
+
+class TestFeedback:
+    """Test suite for learning from human corrections"""
+    
+    @pytest.fixture
+    def classifier(self):
+        """Create classifier instance, the feedback store is isolated by conftest"""
+        return EmailClassifier()
+    
+    def test_learn_updates_local_model(self, classifier):
+        """Test if a correction is applied to the next classification"""
+        email = {
+            "subject": "Zmiana danych w umowie",
+            "body": "Proszę o aktualizację adresu w naszej umowie serwisowej."
+        }
+        update = classifier.learn(email, "Sprzedaż")
+        result = classifier.classify(email)
+        
+        assert update["model_version"] == 1
+        assert update["feedback_count"] == 1
+        assert result["label"] == "Sprzedaż"
+        assert result["method"] == "local-knn"
+    
+    def test_learn_persists_feedback(self, classifier):
+        """Test if corrections are appended to the feedback store"""
+        email = {"subject": "Test", "body": "Test", "sender": None}
+        classifier.learn(email, "IT")
+        
+        with open(classifier.feedback_path, 'r', encoding='utf-8') as f:
+            data = [json.loads(line) for line in f]
+        
+        assert len(data) == 1
+        assert data[0]["label"] == "IT"
+        assert len(EmailClassifier().feedback_data) == 1
+    
+    def test_recorrection_survives_restart(self, classifier):
+        """Test if the newest correction of a classification is loaded after a restart"""
+        email = {"subject": "Test", "body": "Test"}
+        classifier.learn(email, "IT", "abc")
+        classifier.learn(email, "Sprzedaż", "abc")
+        reloaded = EmailClassifier()
+        
+        assert [e["label"] for e in reloaded.feedback_data] == ["Sprzedaż"]
+    
+    def test_corrupt_feedback_store_is_not_overwritten(self, classifier):
+        """Test if a corrupt feedback store raises instead of being replaced"""
+        classifier.learn({"subject": "Test", "body": "Test"}, "IT")
+        with open(classifier.feedback_path, 'a', encoding='utf-8') as f:
+            f.write('{"subject": "Tes')
+        content = classifier.feedback_path.read_text(encoding='utf-8')
+        
+        with pytest.raises(ValueError):
+            EmailClassifier()
+        assert classifier.feedback_path.read_text(encoding='utf-8') == content
+    
+    def test_learn_cost_does_not_grow_with_store(self, classifier, monkeypatch):
+        """Test if kNN rows are stacked in chunks rather than on every correction"""
+        import classifier as classifier_module
+        
+        monkeypatch.setattr(classifier_module, "KNN_CHUNK_SIZE", 4)
+        for i in range(6):
+            classifier.learn({"subject": f"Temat {i}", "body": f"Treść {i}"}, "IT", str(i))
+        
+        assert classifier._knn_vectors.shape[0] == 4
+        assert len(classifier._knn_pending) == 2
+        assert classifier.classify({"subject": "Temat 5", "body": "Treść 5"})["method"] == "local-knn"
+    
+    def test_recorrection_replaces_label(self, classifier):
+        """Test if correcting the same classification again takes the newest label"""
+        email = {"subject": "Zmiana danych", "body": "Proszę o zmianę adresu w umowie."}
+        classifier.learn(email, "Sprzedaż", "abc")
+        update = classifier.learn(email, "Księgowość", "abc")
+        
+        assert update["feedback_count"] == 1
+        assert classifier.classify(email)["label"] == "Księgowość"
+    
+    def test_model_version_survives_restart(self, classifier):
+        """Test if the model version continues from the persisted feedback"""
+        email = {"subject": "Test", "body": "Test"}
+        classifier.learn(email, "IT", "abc")
+        classifier.learn(email, "Sprzedaż", "abc")
+        
+        assert classifier.model_version == 2
+        assert EmailClassifier().model_version == 2
+    
+    def test_seed_data_does_not_skip_llm(self, classifier):
+        """Test if the SGD model trained only on seed data does not answer"""
+        email = {
+            "subject": "Problem z VPN",
+            "body": "Nie mogę się połączyć z VPN firmowym. Connection timeout."
+        }
+        
+        assert classifier._local_classify(email) is None
+    
+    def test_evaluate_skips_local_model(self, classifier, monkeypatch):
+        """Test if evaluation metrics do not come from the local model"""
+        def local_classify(email):
+            raise AssertionError("local model used in evaluate()")
+        
+        monkeypatch.setattr(classifier, "_local_classify", local_classify)
+        metrics = classifier.evaluate()
+        
+        assert metrics["total_predictions"] == len(classifier.training_data)
+    
+    def test_learn_during_warm_up(self, classifier):
+        """Test if a correction during warm-up is stored exactly once"""
+        email = {"subject": "Zmiana danych", "body": "Proszę o zmianę adresu w umowie."}
+        warm_up = threading.Thread(target=classifier.warm_up)
+        warm_up.start()
+        classifier.learn(email, "Sprzedaż", "abc")
+        warm_up.join()
+        
+        assert len(classifier._knn_pending) == len(classifier.feedback_data) == 1
+        assert classifier.classify(email)["label"] == "Sprzedaż"
+    
+    def test_learn_rejects_unknown_label(self, classifier):
+        """Test if unknown department labels are rejected"""
+        with pytest.raises(ValueError):
+            classifier.learn({"subject": "Test", "body": "Test"}, "Marketing")
+
+
 class TestTrainingData:
     """Test suite for training data"""
     